@@ -3,10 +3,13 @@ from __future__ import annotations
 __all__ = ["MemoizedPrefetchConfig"]
 
 import dataclasses
+from collections.abc import Callable
 
 from django.db import models
 from django.db.models import QuerySet
 
+from ._dotted_getattr import compile_dotted_paths, compile_dotted_setter
+
 
 @dataclasses.dataclass
 class MemoizedPrefetchConfig:
@@ -18,7 +21,8 @@ class MemoizedPrefetchConfig:
     If you want to do a memoized prefetch for a many-to-many field, you need to set `is_many_to_many=True` and set the
     through_model of the m2m field. source_field should be the field (string) on the m2m through model that links to the
     source model id. target_field should be the field on the m2m through model (string) that links to the target model
-    id.
+    id. The mapping of source ids to target ids is memoized under `m2m_cache_key`
+    in `MemoizedPrefetch.through_model_source_target_cache`.
 
     There's additional parameters for setting the queryset (to add more select or prefetch related, for example), and
     whether all the objects in the database should be prefetched at the start (for example if there
@@ -26,6 +30,9 @@ class MemoizedPrefetchConfig:
 
     Finally, you can set the LRU cache size - to prevent memory issues, we only keep a certain number of objects in
     the cache, the one most recently used ones. The default cache size is 10000 objects.
+    With `weak_cache=True`, the cache only holds weak references, so objects are only reused while something else
+    (for example objects from previous chunks you still hold on to) keeps them in memory. This cannot be combined
+    with `prefetch_all`, as nothing would keep the prefetched objects in memory.
     """
 
     model: type[models.Model]
@@ -33,23 +40,52 @@ class MemoizedPrefetchConfig:
     queryset: QuerySet | None = None
     prefetch_all: bool = False
     lru_cache_size: int = 10_000
+    weak_cache: bool = False
     is_many_to_many: bool = False
     through_model: type[models.Model] | None = None
     source_field: str | None = None
     target_field: str | None = None
+    m2m_cache_key: str | None = dataclasses.field(init=False, compare=False)
+
+    # returns the ids of all the attributes on an object as a tuple, in the order of the attributes
+    _ids_getter: Callable[[models.Model], tuple] | None = dataclasses.field(init=False, repr=False, compare=False)
+    # set the value of each attribute on an object, in the order of the attributes
+    _assigners: list[Callable[[models.Model, models.Model], None]] = dataclasses.field(
+        init=False, repr=False, compare=False
+    )
+    _seal: bool = dataclasses.field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if self.is_many_to_many and (not self.through_model or not self.source_field or not self.target_field):
             msg = "For many-to-many relationships, through_model, source_field, and target_field must be provided"
             raise ValueError(msg)
 
-    def get_queryset(self) -> QuerySet:
-        if self.queryset is None:
-            queryset = self.model.objects.all()
+        if self.weak_cache and self.prefetch_all:
+            msg = "weak_cache cannot be used with prefetch_all, the prefetched objects would be garbage collected"
+            raise ValueError(msg)
+
+        if self.is_many_to_many:
+            self._ids_getter = None
+            self._assigners = []
+            self.m2m_cache_key = f"{self.through_model.__name__}_{self.source_field}_{self.target_field}"
         else:
-            queryset = self.queryset
+            self._ids_getter = compile_dotted_paths([f"{attribute}_id" for attribute in self.attributes])
+            self._assigners = [compile_dotted_setter(attribute) for attribute in self.attributes]
+            self.m2m_cache_key = None
+
+        # support for django-seal, detected once as get_queryset is called for every chunk
+        self._seal = hasattr(self._get_base_queryset(), "seal")
+
+    def _get_base_queryset(self) -> QuerySet:
+        if self.queryset is None:
+            return self.model._default_manager.all()
+
+        return self.queryset
+
+    def get_queryset(self) -> QuerySet:
+        queryset = self._get_base_queryset()
 
-        if hasattr(queryset, "seal"):  # support for django-seal
+        if self._seal:
             queryset = queryset.seal()
 
         return queryset
@@ -1,6 +1,110 @@
 from __future__ import annotations
 
-__all__ = ["dotted_getattr"]
+__all__ = [
+    "CompiledPath",
+    "compile_dotted_path",
+    "compile_dotted_paths",
+    "compile_dotted_setter",
+    "dotted_getattr",
+    "resolve_dotted_path",
+    "split_dotted_path",
+]
+
+import functools
+from collections.abc import Callable
+from operator import attrgetter
+
+# getter for the whole path, and getters for the `_id` of each intermediate related object on the path
+CompiledPath = tuple[attrgetter, list[attrgetter]]
+
+
+def compile_dotted_path(name: str) -> CompiledPath:
+    """
+    Parses an attribute path split by either __ or . once, so it can be resolved repeatedly with `resolve_dotted_path`.
+
+    For example, `child__fk_id` compiles to `attrgetter("child.fk_id")` for the whole path
+    and `[attrgetter("child_id")]` for checking the intermediate related objects are set.
+    """
+    keys = split_dotted_path(name)
+
+    intermediate_id_getters = [attrgetter(".".join(keys[: i + 1]) + "_id") for i in range(len(keys) - 1)]
+
+    return attrgetter(".".join(keys)), intermediate_id_getters
+
+
+def compile_dotted_paths(names: list[str]) -> Callable[[object], tuple]:
+    """
+    Compiles multiple attribute paths into a single getter, which returns the values of all the paths as a tuple.
+
+    If none of the paths go through intermediate related objects, all of them are resolved by one `attrgetter`.
+    Otherwise, each path falls back to `resolve_dotted_path`, to check the intermediate related objects are set.
+
+    The getter is built from attrgetters and partials of module level functions, so that it can be pickled.
+    """
+    keys_per_name = [split_dotted_path(name) for name in names]
+
+    if not names or any(len(keys) > 1 for keys in keys_per_name):
+        return functools.partial(_resolve_dotted_paths, [compile_dotted_path(name) for name in names])
+
+    if len(names) == 1:
+        # attrgetter with a single attribute does not return a tuple
+        return functools.partial(_get_as_tuple, attrgetter(names[0]))
+
+    return attrgetter(*names)
+
+
+def compile_dotted_setter(name: str) -> Callable[[object, object], None]:
+    """
+    Compiles a setter for an attribute path split by either __ or ., setting the value on the last object in the chain.
+
+    If the attribute is nested (for example invoice__subsidiary), we cannot just run
+    setattr(obj, "invoice__subsidiary", value), as that would not set the subsidiary on the
+    obj.invoice, but rather a new property called "invoice__subsidiary" on the object.
+    Instead, we get the final concrete object in the chain (e.g. obj.invoice if we use the
+    previous example), and set the attribute on that.
+    """
+    keys = split_dotted_path(name)
+    attribute = keys[-1]
+
+    if len(keys) == 1:
+        return functools.partial(_set_attribute, attribute)
+
+    return functools.partial(_set_nested_attribute, attrgetter(".".join(keys[:-1])), attribute)
+
+
+def resolve_dotted_path(obj, compiled: CompiledPath):
+    """
+    On an object, resolves a path compiled by `compile_dotted_path`, returning None if any intermediate related object
+    on the path is not set.
+    """
+    getter, intermediate_id_getters = compiled
+
+    try:
+        return getter(obj)
+    except AttributeError:
+        # either an intermediate related object is not set, so the getter ran into None
+        # (or RelatedObjectDoesNotExist, which is an AttributeError), or the path is actually wrong
+        for intermediate_id_getter in intermediate_id_getters:
+            if intermediate_id_getter(obj) is None:
+                return None
+
+        raise
+
+
+def _resolve_dotted_paths(compiled_paths: list[CompiledPath], obj) -> tuple:
+    return tuple(resolve_dotted_path(obj, compiled) for compiled in compiled_paths)
+
+
+def _get_as_tuple(getter: attrgetter, obj) -> tuple:
+    return (getter(obj),)
+
+
+def _set_attribute(attribute: str, obj, value) -> None:
+    setattr(obj, attribute, value)
+
+
+def _set_nested_attribute(nested_obj_getter: attrgetter, attribute: str, obj, value) -> None:
+    setattr(nested_obj_getter(obj), attribute, value)
 
 
 def dotted_getattr(obj, name):
@@ -12,14 +116,13 @@ def dotted_getattr(obj, name):
     >> dotted_getattr(obj, 'child.fk_id')
     >> dotted_getattr(obj, 'child__fk_id')
     """
-    key_to_use = "__" if "__" in name else "."
-    keys = name.split(key_to_use)
+    return resolve_dotted_path(obj, _compile_dotted_path_cached(name))
 
-    for i, key in enumerate(keys):
-        # if not last one check the related object is actually set
-        if i != len(keys) - 1 and getattr(obj, f"{key}_id") is None:
-            return None
 
-        obj = getattr(obj, key)
+# dotted_getattr is called with the same few names over and over, so don't parse them every time
+_compile_dotted_path_cached = functools.lru_cache(maxsize=1024)(compile_dotted_path)
 
-    return obj
+
+def split_dotted_path(name: str) -> list[str]:
+    key_to_use = "__" if "__" in name else "."
+    return name.split(key_to_use)
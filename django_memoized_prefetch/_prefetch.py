@@ -2,13 +2,19 @@ from __future__ import annotations
 
 __all__ = ["MemoizedPrefetch"]
 
+import itertools
 from collections import defaultdict
+from collections.abc import Callable, Iterator
 
 from django.db import models
 from lru import LRU
 
 from ._config import MemoizedPrefetchConfig
-from ._dotted_getattr import dotted_getattr
+from ._dotted_getattr import split_dotted_path
+from ._weak_lru import WeakValueLRU
+
+_PREFETCH_ALL_CHUNK_SIZE = 2000
+_IN_BATCH_SIZE = 2000
 
 
 class MemoizedPrefetch:
@@ -21,12 +27,19 @@ class MemoizedPrefetch:
 
     MemoizedPrefetch is not as lazy as normal django, so just initialising can make queries, if you for example
     use a MemoizedPrefetchConfig with `prefetch_all=True`.
+
+    Nested attributes can go through an attribute of another config, for example `book` and `book__author`.
+    The config with `book` is then processed first, so `book__author` does not fetch every book one by one.
     """
 
     def __init__(self, *configs: MemoizedPrefetchConfig):
-        self.memoized_objects: dict[type[models.Model], LRU[int, models.Model]] = {}
+        self.memoized_objects: dict[type[models.Model], LRU[int, models.Model] | WeakValueLRU] = {}
         self.memoized_objects_configs: dict[type[models.Model], MemoizedPrefetchConfig] = {}
         self.through_model_source_target_cache: dict[str, LRU[int, list[int]]] = {}
+        foreign_key_configs: list[MemoizedPrefetchConfig] = []
+        self._m2m_configs: list[MemoizedPrefetchConfig] = []
+        # models with prefetch_all=True, where all the objects in the database fit into the cache and none were evicted
+        self._complete_models: set[type[models.Model]] = set()
 
         for config in configs:
             if config.model in self.memoized_objects_configs:
@@ -37,122 +50,297 @@ class MemoizedPrefetch:
                 raise ValueError(msg)
 
             self.memoized_objects_configs[config.model] = config
-            self.memoized_objects[config.model] = LRU(config.lru_cache_size)
+            if config.weak_cache:
+                self.memoized_objects[config.model] = WeakValueLRU(config.lru_cache_size)
+            else:
+                self.memoized_objects[config.model] = LRU(config.lru_cache_size)
+
+            if config.is_many_to_many:
+                self._m2m_configs.append(config)
+            else:
+                foreign_key_configs.append(config)
 
             if config.prefetch_all:
-                # can't use in_bulk with limiting the queryset to cache size
-                self.memoized_objects[config.model].update(
-                    {x.id: x for x in config.get_queryset()[: config.lru_cache_size]}
-                )
+                # can't use in_bulk with limiting the queryset to cache size, iterate so that the queryset does not
+                # keep its own copy of all the objects in its result cache
+                memoized_objects = self.memoized_objects[config.model]
+                for x in config.get_queryset()[: config.lru_cache_size].iterator(chunk_size=_PREFETCH_ALL_CHUNK_SIZE):
+                    memoized_objects[x.id] = x
+
+                if len(memoized_objects) < config.lru_cache_size:
+                    self._complete_models.add(config.model)
+
+        # foreign key configs grouped so that each group only depends on attributes assigned by the previous ones
+        self._foreign_key_levels: list[list[MemoizedPrefetchConfig]] = _dependency_levels(foreign_key_configs)
 
     def _get_m2m_related_ids(self, obj_ids: list[int], config: MemoizedPrefetchConfig) -> LRU:
         # Maps source ids (model) to target ids (through model target), and updates cache
-        if not config.through_model or not config.source_field or not config.target_field:
-            msg = "If is_many_to_many is True, through_model, source_field, and target_field must be provided."
-            raise ValueError(msg)
-
-        cache_key = f"{config.through_model.__name__}_{config.source_field}_{config.target_field}"
+        # the through model, source and target fields are validated by MemoizedPrefetchConfig
+        cache_key = config.m2m_cache_key
 
         if cache_key not in self.through_model_source_target_cache:
             self.through_model_source_target_cache[cache_key] = LRU(config.lru_cache_size)
 
-        if all(obj_id in self.through_model_source_target_cache[cache_key] for obj_id in obj_ids):
-            return self.through_model_source_target_cache[cache_key]
-
-        unseen_ids = set(obj_ids) - set(self.through_model_source_target_cache[cache_key].keys())
-        through_objects = config.through_model.objects.filter(**{f"{config.source_field}__in": unseen_ids}).values_list(
-            config.source_field, config.target_field
-        )
         mapping = self.through_model_source_target_cache[cache_key]
 
-        for source_id, target_id in through_objects:
-            if source_id not in mapping:
-                mapping[source_id] = []
-            mapping[source_id].append(target_id)
+        # check membership in the LRU directly, rather than copying all its keys into a set
+        unseen_ids = {obj_id for obj_id in obj_ids if obj_id not in mapping}
+        if not unseen_ids:
+            return mapping
+
+        new_mapping: dict[int, list[int]] = defaultdict(list)
+        for batch in _batched(sorted(unseen_ids), _IN_BATCH_SIZE):
+            through_objects = config.through_model.objects.filter(**{f"{config.source_field}__in": batch}).values_list(
+                config.source_field, config.target_field
+            )
+
+            for source_id, target_id in through_objects:
+                new_mapping[source_id].append(target_id)
+
+        # ids without any through objects are memoized as well, so they're not fetched again in the next chunk
+        for source_id in unseen_ids:
+            mapping[source_id] = new_mapping.get(source_id, [])
 
-        self.through_model_source_target_cache[cache_key].update(mapping)
         return mapping
 
     def process_chunk(self, objects: list[models.Model]) -> None:
-        # find all the objects we need to have to process this chunk
-        need_objects: dict[type[models.Model], set[int]] = defaultdict(set)
-        obj_ids = [obj.id for obj in objects]
+        if not objects:
+            return
 
-        for config in self.memoized_objects_configs.values():
-            if config.is_many_to_many:
+        # find all the objects we need to have to process this chunk, and are not already memoized
+        need_to_prefetch: dict[type[models.Model], set[int]] = defaultdict(set)
+
+        # models where all the objects are memoized, so there's no need to collect which ones are needed
+        complete_models = self._complete_models.copy()
+
+        # memoized objects of weak caches which this chunk needs, held until it's assigned, so they're not garbage
+        # collected in between. They might only be referenced by garbage reference cycles, e.g. from dropped chunks
+        weakly_memoized: dict[type[models.Model], dict[int, models.Model]] = {}
+
+        if self._m2m_configs:
+            obj_ids = [obj.id for obj in objects]
+
+            for config in self._m2m_configs:
                 related_ids = self._get_m2m_related_ids(obj_ids, config)
-                for target_ids in related_ids.values():
-                    need_objects[config.model].update(target_ids)
-            else:
-                for obj in objects:
-                    for attribute in config.attributes:
-                        if pk := dotted_getattr(obj, f"{attribute}_id"):
-                            need_objects[config.model].add(pk)
-
-        # figure out which objects we need to fetch (not already memoized)
-        need_to_prefetch: dict[type[models.Model], set[int]] = {}
-        for cls, need_ids in need_objects.items():
-            need_ids = need_ids - set(self.memoized_objects[cls].keys())
-            if need_ids:
-                need_to_prefetch[cls] = need_ids
+                if config.model in complete_models:
+                    continue
 
-        # prefetch the new objects which are needed
-        for cls, need_ids in need_to_prefetch.items():
-            new_objects = self.memoized_objects_configs[cls].get_queryset().in_bulk(need_ids)
-            # We need to temporarily increase the LRU limit, so the objects that are there do not get cleared
-            # because we already rely on them being there
-            self.memoized_objects[cls].set_size(self.memoized_objects[cls].get_size() + len(new_objects))
-            self.memoized_objects[cls].update(new_objects)
+                memoized_objects = self.memoized_objects[config.model]
+                pks = itertools.chain.from_iterable(related_ids.get(obj_id, ()) for obj_id in obj_ids)
 
-        # assign the attributes on the chunk now we have everything loaded
-        for obj in objects:
-            for config in self.memoized_objects_configs.values():
-                if config.is_many_to_many:
-                    self._assign_attributes_from_cache_m2m(config, obj)
+                if config.weak_cache:
+                    held = weakly_memoized[config.model] = {}
+                    for pk in pks:
+                        if pk not in held:
+                            if (value := memoized_objects.get(pk)) is not None:
+                                held[pk] = value
+                            else:
+                                need_to_prefetch[config.model].add(pk)
                 else:
-                    self._assign_attributes_from_cache_foreign_key(config, obj)
+                    need_to_prefetch[config.model].update(pk for pk in pks if pk not in memoized_objects)
+
+        # prefetch the new objects which are needed. They're kept aside until the whole chunk is assigned,
+        # because adding them to the LRU cache straight away could evict objects we already rely on being there
+        new_objects: dict[type[models.Model], dict[int, models.Model]] = {}
+
+        # each level is assigned before the next one is processed, as its nested attributes go through these ones
+        for level in self._foreign_key_levels:
+            self._process_foreign_key_configs(objects, level, new_objects)
+
+        for cls, need_ids in need_to_prefetch.items():
+            if need_ids:
+                new_objects[cls] = self._fetch_objects(self.memoized_objects_configs[cls], need_ids)
+
+        if self._m2m_configs:
+            # objects held from weak caches are looked up together with the newly fetched ones
+            for cls, held in weakly_memoized.items():
+                held.update(new_objects.get(cls, {}))
+
+            m2m_configs = [
+                (
+                    config,
+                    self.through_model_source_target_cache[config.m2m_cache_key],
+                    self.memoized_objects[config.model],
+                    weakly_memoized.get(config.model) or new_objects.get(config.model, {}),
+                    config.model in complete_models,
+                )
+                for config in self._m2m_configs
+            ]
+            missing: dict[type[models.Model], set[int]] = defaultdict(set)
+            missing_objects: dict[type[models.Model], list[models.Model]] = defaultdict(list)
 
-        # set the correct size for the LRU cache (as we temporarily increased the size before)
-        for cls, config in self.memoized_objects_configs.items():
-            self.memoized_objects[cls].set_size(config.lru_cache_size)
+            for obj in objects:
+                for config, mapping, memoized_objects, config_new_objects, is_complete in m2m_configs:
+                    missing_ids = self._assign_attributes_from_cache_m2m(
+                        config, obj, mapping.get(obj.id, []), memoized_objects, config_new_objects
+                    )
+                    if missing_ids and is_complete:
+                        missing[config.model].update(missing_ids)
+                        missing_objects[config.model].append(obj)
 
-    def _assign_attributes_from_cache_m2m(self, config: MemoizedPrefetchConfig, obj: models.Model) -> None:
-        cache_key = f"{config.through_model.__name__}_{config.source_field}_{config.target_field}"
-        related_ids = self.through_model_source_target_cache[cache_key].get(obj.id, [])
-        related_objects = [
-            self.memoized_objects[config.model][pk] for pk in related_ids if pk in self.memoized_objects[config.model]
+            # objects which were created after prefetching all of them, fetch them and add them to the caches
+            for cls, missing_ids in missing.items():
+                config = self.memoized_objects_configs[cls]
+                mapping = self.through_model_source_target_cache[config.m2m_cache_key]
+                cls_new_objects = new_objects.setdefault(cls, {})
+                cls_new_objects.update(self._fetch_objects(config, missing_ids))
+                for obj in missing_objects[cls]:
+                    self._assign_attributes_from_cache_m2m(
+                        config, obj, mapping.get(obj.id, []), self.memoized_objects[cls], cls_new_objects
+                    )
+
+        # memoize the new objects, the LRU cache evicts the least recently used ones to stay within its size
+        for cls, cls_new_objects in new_objects.items():
+            memoized_objects = self.memoized_objects[cls]
+            memoized_objects.update(cls_new_objects)
+
+            # the LRU cache only evicts objects once it's full, so from then on it might not have all of them
+            if (
+                cls in self._complete_models
+                and len(memoized_objects) >= self.memoized_objects_configs[cls].lru_cache_size
+            ):
+                self._complete_models.discard(cls)
+
+    def _process_foreign_key_configs(
+        self,
+        objects: list[models.Model],
+        configs: list[MemoizedPrefetchConfig],
+        new_objects: dict[type[models.Model], dict[int, models.Model]],
+    ) -> None:
+        # for foreign keys, the memoized objects are assigned in the same pass over the chunk, only the attributes
+        # of objects which are not memoized yet are deferred until they're fetched
+        need_to_prefetch: dict[type[models.Model], set[int]] = defaultdict(set)
+        deferred: dict[type[models.Model], list[tuple[models.Model, Callable, int]]] = defaultdict(list)
+
+        # everything the loop needs per config is looked up once per chunk, not once per object
+        foreign_key_configs = [
+            (
+                config._ids_getter,
+                config._assigners,
+                self.memoized_objects[config.model],
+                need_to_prefetch[config.model],
+                deferred[config.model],
+            )
+            for config in configs
         ]
+
+        for obj in objects:
+            for ids_getter, assigners, memoized_objects, need_ids, cls_deferred in foreign_key_configs:
+                # the getter returns a value for each assigner, and zip(strict=) is not available on python 3.9
+                for pk, assigner in zip(ids_getter(obj), assigners):  # noqa: B905
+                    if not pk:
+                        continue
+
+                    if (value := memoized_objects.get(pk)) is not None:
+                        assigner(obj, value)
+                    else:
+                        need_ids.add(pk)
+                        cls_deferred.append((obj, assigner, pk))
+
+        for cls, need_ids in need_to_prefetch.items():
+            if need_ids:
+                new_objects[cls] = self._fetch_objects(self.memoized_objects_configs[cls], need_ids)
+
+        # assign the rest of the attributes on the chunk now we have everything loaded
+        for cls, cls_deferred in deferred.items():
+            cls_new_objects = new_objects.get(cls, {})
+            for obj, assigner, pk in cls_deferred:
+                assigner(obj, cls_new_objects[pk])
+
+    def _fetch_objects(self, config: MemoizedPrefetchConfig, ids: set[int]) -> dict[int, models.Model]:
+        # fetched in batches to limit the size of the IN (...) clause, the ids are sorted
+        # so the same ids always produce the same queries
+        queryset = config.get_queryset()
+        objects: dict[int, models.Model] = {}
+        for batch in _batched(sorted(ids), _IN_BATCH_SIZE):
+            objects.update(queryset.in_bulk(batch))
+        return objects
+
+    def _assign_attributes_from_cache_m2m(
+        self,
+        config: MemoizedPrefetchConfig,
+        obj: models.Model,
+        related_ids: list[int],
+        memoized_objects: LRU[int, models.Model] | WeakValueLRU,
+        new_objects: dict[int, models.Model],
+    ) -> list[int]:
+        # returns ids of related objects which are neither memoized nor newly fetched
+        related_objects = []
+        missing_ids = []
+        for pk in related_ids:
+            # a single lookup in each, LRU.get marks the object as recently used same as indexing does
+            related_obj = new_objects.get(pk)
+            if related_obj is None:
+                related_obj = memoized_objects.get(pk)
+
+            if related_obj is None:
+                missing_ids.append(pk)
+            else:
+                related_objects.append(related_obj)
+        # the first attribute without a cache gets the list itself, any further ones get a copy,
+        # so that merging into one attribute's cache in a later chunk doesn't change the others
+        related_objects_used = False
+
+        if not hasattr(obj, "_prefetched_objects_cache"):
+            obj._prefetched_objects_cache = {}
+
         for attribute in config.attributes:
             # Set in django's internal prefetched objects cache
             # can't use .set as that will cause a lot more queries
-            if hasattr(obj, "_prefetched_objects_cache") and attribute in obj._prefetched_objects_cache:
-                existing_cache = obj._prefetched_objects_cache[attribute]
+            existing_cache = obj._prefetched_objects_cache.get(attribute)
 
-                existing_ids = {existing.id for existing in existing_cache}
-                for related_obj in related_objects:
-                    if related_obj.id not in existing_ids:
-                        existing_cache.add(related_obj)
+            if existing_cache is None:
+                # store a queryset with its result cache filled in, same as django's prefetch_related does,
+                # so the related manager works as usual, e.g. `.count()` uses the cache, `.filter()` makes a new query
+                queryset = getattr(obj, attribute).get_queryset()
+                if related_objects_used:
+                    queryset._result_cache = related_objects.copy()
+                else:
+                    queryset._result_cache = related_objects
+                    related_objects_used = True
+                queryset._prefetch_done = True
+                obj._prefetched_objects_cache[attribute] = queryset
             else:
-                if not hasattr(obj, "_prefetched_objects_cache"):
-                    obj._prefetched_objects_cache = {}
-                obj._prefetched_objects_cache[attribute] = set(related_objects)
+                existing_ids = {existing.id for existing in existing_cache}
+                existing_cache._result_cache.extend(
+                    related_obj for related_obj in related_objects if related_obj.id not in existing_ids
+                )
 
-    def _assign_attributes_from_cache_foreign_key(self, config: MemoizedPrefetchConfig, obj: models.Model) -> None:
-        for attribute in config.attributes:
-            if not (pk := dotted_getattr(obj, f"{attribute}_id")):
-                continue
-
-            value = self.memoized_objects[config.model][pk]
-
-            # If the attribute is nested (for example invoice__subsidiary), we cannot just run
-            # setattr(obj, "invoice__subsidiary", value), as that would not set the subsidiary on the
-            # obj.invoice, but rather a new property called "invoice__subsidiary" on the object.
-            # Instead, we detect the final concrete object in the chain (e.g. obj.invoice if we use the
-            # previous example), and set the attribute on that.
-            if "__" in attribute or "." in attribute:
-                key_to_use = "__" if "__" in attribute else "."
-                # will for example be nested_obj="invoice" and nested_attribute="subsidiary"
-                nested_obj, nested_attribute = attribute.rsplit(key_to_use, 1)
-                setattr(dotted_getattr(obj, nested_obj), nested_attribute, value)
-            else:
-                setattr(obj, attribute, value)
+        return missing_ids
+
+
+def _batched(ids: list[int], size: int) -> Iterator[list[int]]:
+    for i in range(0, len(ids), size):
+        yield ids[i : i + size]
+
+
+def _dependency_levels(configs: list[MemoizedPrefetchConfig]) -> list[list[MemoizedPrefetchConfig]]:
+    # a config depends on another one if any of its nested attributes goes through an attribute of the other config,
+    # e.g. `book__author` on `book`. Configs keep their order within a level.
+    config_by_path = {
+        tuple(split_dotted_path(attribute)): config for config in configs for attribute in config.attributes
+    }
+
+    dependencies: dict[type[models.Model], set[type[models.Model]]] = {}
+    for config in configs:
+        prefixes = {tuple(keys[:i]) for keys in map(split_dotted_path, config.attributes) for i in range(1, len(keys))}
+        dependencies[config.model] = {
+            config_by_path[prefix].model for prefix in prefixes if prefix in config_by_path
+        } - {config.model}
+
+    levels: list[list[MemoizedPrefetchConfig]] = []
+    processed: set[type[models.Model]] = set()
+    remaining = configs
+    while remaining:
+        level = [config for config in remaining if dependencies[config.model] <= processed]
+        if not level:
+            # the rest depend on each other in a cycle, so process them together in a single pass,
+            # some of the intermediate objects are then fetched one by one when resolving the nested attributes
+            levels.append(remaining)
+            break
+
+        levels.append(level)
+        processed.update(config.model for config in level)
+        remaining = [config for config in remaining if config.model not in processed]
+
+    return levels
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+__all__ = ["WeakValueLRU"]
+
+import weakref
+from collections.abc import Iterator, Mapping
+from typing import Any
+
+from lru import LRU
+
+
+class WeakValueLRU:
+    """
+    An LRU cache which only holds weak references to its values, with the parts of the `LRU` interface that
+    MemoizedPrefetch uses.
+
+    Values which are no longer referenced anywhere else get garbage collected, they're then treated as if they were
+    never in the cache.
+    """
+
+    def __init__(self, size: int):
+        self._lru: LRU[Any, weakref.ref] = LRU(size)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        self._lru[key] = weakref.ref(value)
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __iter__(self) -> Iterator:
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        ref = self._lru.get(key)
+        if ref is None:
+            return default
+
+        value = ref()
+        if value is None:
+            # garbage collected, no point in keeping the dead reference around
+            del self._lru[key]
+            return default
+
+        return value
+
+    def update(self, values: Mapping) -> None:
+        self._lru.update({key: weakref.ref(value) for key, value in values.items()})
+
+    def keys(self) -> list:
+        return [key for key, _ in self.items()]
+
+    def values(self) -> list:
+        return [value for _, value in self.items()]
+
+    def items(self) -> list[tuple]:
+        return [(key, value) for key, ref in self._lru.items() if (value := ref()) is not None]
+
+    def get_size(self) -> int:
+        return self._lru.get_size()
+
+    def set_size(self, size: int) -> None:
+        self._lru.set_size(size)
@@ -0,0 +1,42 @@
+import pickle
+
+import pytest
+
+from django_memoized_prefetch._dotted_getattr import compile_dotted_paths, dotted_getattr
+from tests.test_project.test_app.models import SomeChildModel, SomeModel, SomeParentModel
+
+
+class TestDottedGetattr:
+    def test_dotted_getattr(self):
+        parent = SomeParentModel(id=1)
+        obj = SomeChildModel(some_model=SomeModel(id=2, some_parent_model=parent))
+
+        assert dotted_getattr(obj, "some_model.some_parent_model_id") == 1
+        assert dotted_getattr(obj, "some_model__some_parent_model") is parent
+
+    def test_intermediate_not_set(self):
+        obj = SomeChildModel()
+
+        assert dotted_getattr(obj, "some_model__some_parent_model_id") is None
+
+    def test_wrong_path(self):
+        obj = SomeChildModel(some_model=SomeModel(id=2))
+
+        with pytest.raises(AttributeError):
+            dotted_getattr(obj, "some_model__not_a_field")
+
+    @pytest.mark.parametrize(
+        ["names", "expected"],
+        [
+            ([], ()),
+            (["some_model_id"], (2,)),
+            (["some_model_id", "name"], (2, "child")),
+            (["some_model__some_parent_model_id", "some_model_id"], (1, 2)),
+        ],
+    )
+    def test_compile_dotted_paths_pickle(self, names: list[str], expected: tuple):
+        obj = SomeChildModel(name="child", some_model=SomeModel(id=2, some_parent_model=SomeParentModel(id=1)))
+
+        getter = pickle.loads(pickle.dumps(compile_dotted_paths(names)))  # noqa: S301
+
+        assert getter(obj) == expected
@@ -1,7 +1,11 @@
+import gc
 import itertools
+import pickle
+import weakref
 
 import pytest
 from dirty_equals import IsDict, IsList, IsPartialDict
+from django.db.models import QuerySet
 from pytest_django import DjangoAssertNumQueries
 
 from django_memoized_prefetch import MemoizedPrefetch, MemoizedPrefetchConfig
@@ -14,6 +18,7 @@ from tests.test_project.test_app.factories import (
 )
 from tests.test_project.test_app.models import (
     SomeChildModel,
+    SomeCustomManagerModel,
     SomeDifferentParentModel,
     SomeModel,
     SomeParentModel,
@@ -63,6 +68,41 @@ class TestMemoizedPrefetch:
                 MemoizedPrefetchConfig(SomeParentModel, ["some_other_parent"], prefetch_all=True),
             )
 
+        with pytest.raises(ValueError, match="weak_cache cannot be used with prefetch_all"):
+            MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"], prefetch_all=True, weak_cache=True)
+
+    def test_custom_manager(self):
+        obj = SomeCustomManagerModel.items.create(name="a")
+
+        # the model has no `objects` manager
+        config = MemoizedPrefetchConfig(SomeCustomManagerModel, ["some_custom_manager_model"])
+        assert list(config.get_queryset()) == [obj]
+
+        config = MemoizedPrefetchConfig(
+            SomeCustomManagerModel, ["some_custom_manager_model"], queryset=SomeCustomManagerModel.items.all()
+        )
+        assert list(config.get_queryset()) == [obj]
+
+    def test_config_pickle(self, child_models: list[SomeChildModel]):
+        configs = [
+            MemoizedPrefetchConfig(SomeModel, ["some_model"]),
+            MemoizedPrefetchConfig(SomeParentModel, ["some_model__some_parent_model"]),
+            MemoizedPrefetchConfig(SomeDifferentParentModel, ["some_model.some_other_different_parent"]),
+        ]
+
+        # e.g. to pass them to other processes
+        memoized_prefetch = MemoizedPrefetch(*pickle.loads(pickle.dumps(configs)))  # noqa: S301
+
+        objects = list(SomeChildModel.objects.seal())
+        memoized_prefetch.process_chunk(objects)
+
+        assert objects
+
+        for obj in objects:
+            # does not throw seal attribute -> fetched in process_chunk
+            assert obj.some_model.some_parent_model is not None
+            assert obj.some_model.some_other_different_parent is not None
+
     def test_memoized_prefetch(
         self,
         django_assert_num_queries: DjangoAssertNumQueries,
@@ -123,6 +163,53 @@ class TestMemoizedPrefetch:
             assert obj.some_parent_model is not None
             assert obj.some_other_different_parent is not None
 
+    def test_memoized_prefetch_empty_chunk(self, django_assert_num_queries: DjangoAssertNumQueries):
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"]),
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+            ),
+        )
+
+        with django_assert_num_queries(0):
+            memoized_prefetch.process_chunk([])
+
+    def test_memoized_prefetch_weak_cache(self, django_assert_num_queries: DjangoAssertNumQueries):
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"], weak_cache=True)
+        )
+
+        objects = list(SomeModel.objects.seal())
+
+        with django_assert_num_queries(1):
+            memoized_prefetch.process_chunk(objects)
+
+        other_objects = list(SomeModel.objects.seal())
+
+        with django_assert_num_queries(0):  # parents are still referenced by the previous objects
+            memoized_prefetch.process_chunk(other_objects)
+
+        assert other_objects[0].some_parent_model is objects[0].some_parent_model
+
+        del objects, other_objects
+        gc.collect()
+
+        assert dict(memoized_prefetch.memoized_objects[SomeParentModel]) == {}
+
+        objects = list(SomeModel.objects.seal())
+
+        with django_assert_num_queries(1):  # parents were garbage collected, so they're fetched again
+            memoized_prefetch.process_chunk(objects)
+
+        for obj in objects:
+            # does not throw seal attribute -> fetched in process_chunk
+            assert obj.some_parent_model is not None
+
     @pytest.fixture
     def objects_with_m2m_set(self) -> list[SomeModel]:
         return SomeModelFactory.create_batch(
@@ -156,10 +243,183 @@ class TestMemoizedPrefetch:
 
         assert objects
 
+        with django_assert_num_queries(0):  # uses the prefetched objects
+            for obj in objects:
+                related_models = list(obj.some_related_models.all())
+                assert len(related_models) == 2
+                assert all(rel_model.name for rel_model in related_models)
+                assert obj.some_related_models.count() == 2
+
+        # filtering makes a new query, limited to the related objects
+        related_model = objects[0].some_related_models.all()[0]
+        assert list(objects[0].some_related_models.filter(name=related_model.name)) == [related_model]
+
+    def test_memoized_prefetch_many_to_many_weak_cache(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        django_assert_num_queries: DjangoAssertNumQueries,
+        objects_with_m2m_set: list[SomeModel],
+    ) -> None:
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"]),
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+                weak_cache=True,
+            ),
+        )
+        ids = [obj.id for obj in objects_with_m2m_set]
+
+        gc.disable()
+        try:
+            objects = list(SomeModel.objects.filter(id__in=ids).seal())
+
+            with django_assert_num_queries(2):  # one query to the through model, one to get objects
+                memoized_prefetch.process_chunk(objects)
+
+            # the related objects are now only referenced by reference cycles of the prefetched querysets
+            del objects
+
+            # garbage collection can run at any point while processing the chunk, e.g. while fetching foreign keys
+            process_foreign_key_configs = memoized_prefetch._process_foreign_key_configs
+
+            def collect_and_process_foreign_key_configs(*args) -> None:
+                gc.collect()
+                process_foreign_key_configs(*args)
+
+            monkeypatch.setattr(
+                memoized_prefetch, "_process_foreign_key_configs", collect_and_process_foreign_key_configs
+            )
+
+            objects = list(SomeModel.objects.filter(id__in=ids).seal())
+
+            with django_assert_num_queries(0):  # related objects were still memoized when the chunk was processed
+                memoized_prefetch.process_chunk(objects)
+        finally:
+            gc.enable()
+
         for obj in objects:
             related_models = list(obj.some_related_models.all())
             assert len(related_models) == 2
-            assert all(rel_model.name for rel_model in related_models)
+
+    def test_memoized_prefetch_many_to_many_without_related(
+        self,
+        django_assert_num_queries: DjangoAssertNumQueries,
+        objects_some_different_parent_a: list[SomeModel],
+        objects_some_different_parent_b: list[SomeModel],
+    ) -> None:
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+            )
+        )
+        ids = [obj.id for obj in [*objects_some_different_parent_a, *objects_some_different_parent_b]]
+
+        with django_assert_num_queries(2):  # one query to get objects, one to the through model
+            memoized_prefetch.process_chunk(SomeModel.objects.filter(id__in=ids).seal())
+
+        objects = list(SomeModel.objects.filter(id__in=ids).seal())
+
+        with django_assert_num_queries(0):  # already known there's no related objects
+            memoized_prefetch.process_chunk(objects)
+
+        assert objects
+
+        for obj in objects:
+            assert list(obj.some_related_models.all()) == []
+
+    def test_memoized_prefetch_many_to_many_prefetch_all(
+        self, django_assert_num_queries: DjangoAssertNumQueries, objects_with_m2m_set: list[SomeModel]
+    ) -> None:
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+                prefetch_all=True,
+            )
+        )
+
+        with django_assert_num_queries(2):  # one query to get objects, one to the through model
+            memoized_prefetch.process_chunk(
+                SomeModel.objects.filter(id__in=[obj.id for obj in objects_with_m2m_set]).seal()
+            )
+
+        # related objects created after prefetching all of them are still fetched
+        new_objects_with_m2m_set = SomeModelFactory.create_batch(
+            2,
+            some_parent_model=None,
+            some_other_parent=None,
+            some_related_models=SomeRelatedModelFactory.create_batch(1),
+        )
+        objects = list(SomeModel.objects.filter(id__in=[obj.id for obj in new_objects_with_m2m_set]).seal())
+
+        with django_assert_num_queries(2):  # one query to the through model, one to the new related objects
+            memoized_prefetch.process_chunk(objects)
+
+        for obj in objects:
+            related_models = list(obj.some_related_models.all())
+            assert len(related_models) == 1
+            assert related_models[0].name
+
+    def test_memoized_prefetch_prefetch_all_garbage_collected(self, objects_with_m2m_set: list[SomeModel]) -> None:
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"], prefetch_all=True),
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+                prefetch_all=True,
+            ),
+        )
+        memoized_prefetch.process_chunk(list(SomeModel.objects.seal()))
+
+        ref = weakref.ref(memoized_prefetch)
+        del memoized_prefetch
+        gc.collect()
+
+        # nothing, e.g. a callback of the LRU caches, keeps the instance and all the memoized objects alive
+        assert ref() is None
+
+    def test_memoized_prefetch_many_to_many_already_prefetched(self, objects_with_m2m_set: list[SomeModel]) -> None:
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(
+                model=SomeRelatedModel,
+                through_model=SomeModel.some_related_models.through,
+                is_many_to_many=True,
+                attributes=["some_related_models"],
+                source_field="somemodel_id",
+                target_field="somerelatedmodel_id",
+            )
+        )
+        objects = list(
+            SomeModel.objects.filter(id__in=[obj.id for obj in objects_with_m2m_set])
+            .prefetch_related("some_related_models")
+            .seal()
+        )
+
+        memoized_prefetch.process_chunk(objects)
+
+        assert objects
+
+        for obj in objects:
+            related_models = list(obj.some_related_models.all())
+            assert len(related_models) == 2  # not duplicated with the objects prefetched by django
 
     def test_nullable_field(
         self,
@@ -206,6 +466,63 @@ class TestMemoizedPrefetch:
             assert obj.some_model.some_parent_model is not None
             assert obj.some_model.some_other_different_parent is not None
 
+    def test_nested_intermediate_config(
+        self, child_models: list[SomeChildModel], django_assert_num_queries: DjangoAssertNumQueries
+    ):
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(SomeParentModel, ["some_model__some_parent_model"], prefetch_all=True),
+            MemoizedPrefetchConfig(SomeDifferentParentModel, ["some_model.some_other_different_parent"]),
+            # listed last, but the nested attributes go through it, so it's assigned first
+            MemoizedPrefetchConfig(SomeModel, ["some_model"], queryset=SomeModel.objects.seal()),
+        )
+
+        objects = list(SomeChildModel.objects.seal())
+
+        # some models, some different parents, the parents are all prefetched
+        with django_assert_num_queries(2):
+            memoized_prefetch.process_chunk(objects)
+
+        assert objects
+
+        for obj in objects:
+            # does not throw seal attribute -> fetched in process_chunk
+            assert obj.some_model.some_parent_model is not None
+            assert obj.some_model.some_other_different_parent is not None
+
+    def test_nested_cycle(
+        self,
+        parent_a: SomeParentModel,
+        objects_some_different_parent_a: list[SomeModel],
+        objects_some_different_parent_b: list[SomeModel],
+    ):
+        preferred_model = objects_some_different_parent_b[0]
+        parent_a.some_preferred_model = preferred_model
+        parent_a.save()
+
+        # the configs go through each other's attributes, so they're processed together in a single pass,
+        # which fetches some of the intermediate objects one by one, so the querysets can't be sealed
+        memoized_prefetch = MemoizedPrefetch(
+            MemoizedPrefetchConfig(
+                SomeParentModel,
+                ["some_parent_model", "some_parent_model__some_preferred_model__some_other_parent"],
+                queryset=QuerySet(SomeParentModel),
+            ),
+            MemoizedPrefetchConfig(
+                SomeModel, ["some_parent_model__some_preferred_model"], queryset=QuerySet(SomeModel)
+            ),
+        )
+
+        objects = list(SomeModel.objects.filter(id__in=[obj.id for obj in objects_some_different_parent_a]))
+
+        memoized_prefetch.process_chunk(objects)
+
+        assert objects
+
+        for obj in objects:
+            assert obj.some_parent_model == parent_a
+            assert obj.some_parent_model.some_preferred_model == preferred_model
+            assert obj.some_parent_model.some_preferred_model.some_other_parent == preferred_model.some_other_parent
+
 
 class TestMemoizedPrefetchLRU:
     @pytest.fixture(autouse=True)
@@ -252,6 +569,22 @@ class TestMemoizedPrefetchLRU:
             *[obj.some_parent_model for obj in objects[5:15]], check_order=False
         )
 
+    def test_memoized_prefetch_batches(
+        self,
+        django_assert_num_queries: DjangoAssertNumQueries,
+        monkeypatch: pytest.MonkeyPatch,
+        some_models: list[SomeModel],
+    ):
+        monkeypatch.setattr("django_memoized_prefetch._prefetch._IN_BATCH_SIZE", 6)
+        objects = list(SomeModel.objects.all().seal())
+        memoized_prefetch = MemoizedPrefetch(MemoizedPrefetchConfig(SomeParentModel, ["some_parent_model"]))
+
+        with django_assert_num_queries(4):  # 20 parents in batches of 6
+            memoized_prefetch.process_chunk(objects)
+
+        for obj in objects:
+            assert obj.some_parent_model is not None  # does not throw seal attribute -> fetched in process_chunk
+
     @pytest.fixture
     def some_models_with_related(self) -> list[SomeModel]:
         return SomeModelFactory.create_batch(
@@ -284,6 +617,7 @@ class TestMemoizedPrefetchLRU:
             assert obj.some_related_models.all()  # does not throw seal attribute
 
         cache_key = "SomeModel_some_related_models_somemodel_id_somerelatedmodel_id"
+        assert memoized_prefetch.memoized_objects_configs[SomeRelatedModel].m2m_cache_key == cache_key
 
         assert memoized_prefetch.through_model_source_target_cache[cache_key].get_size() == 10  # cache size is 10
 
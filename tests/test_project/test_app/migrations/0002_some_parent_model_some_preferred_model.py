@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-14 18:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("test_app", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="someparentmodel",
+            name="some_preferred_model",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="test_app.somemodel",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-14 18:57
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("test_app", "0002_some_parent_model_some_preferred_model"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SomeCustomManagerModel",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=255)),
+            ],
+            managers=[
+                ("items", django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -13,6 +13,10 @@ class SomeParentModel(SealableModel):
     some_parent_date = models.DateField(auto_now=True, blank=True, null=True)
     some_parent_datetime = models.DateTimeField(auto_now=True, blank=True, null=True)
 
+    some_preferred_model = models.ForeignKey(
+        "SomeModel", on_delete=models.SET_NULL, related_name="+", blank=True, null=True
+    )
+
     class Meta:
         ordering = ("id",)
 
@@ -52,3 +56,9 @@ class SomeChildModel(SealableModel):
 
     class Meta:
         ordering = ("id",)
+
+
+class SomeCustomManagerModel(models.Model):
+    name = models.CharField(max_length=255)
+
+    items = models.Manager()
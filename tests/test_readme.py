@@ -1,53 +1,109 @@
+import itertools
+import random
+from collections.abc import Iterable, Iterator
+
 import pytest
-from chunkator import chunkator_page
+from django.db import transaction
+from pytest_django import DjangoAssertNumQueries
 
 from django_memoized_prefetch import MemoizedPrefetch, MemoizedPrefetchConfig
-from tests.test_project.bookshop.factories import BookFactory, ReviewFactory
+from tests.test_project.bookshop.factories import BookFactory, CategoryFactory, ReviewFactory
 from tests.test_project.bookshop.models import Author, Book, Category, Publisher, Review
 
 pytestmark = pytest.mark.django_db
 
 
-class TestReadmeExamples:
-    @pytest.fixture(autouse=True)
-    def setup(self):
-        BookFactory.create_batch(100)
-        ReviewFactory.create_batch(100)
+# The tests mirror the examples in README.md. batched(queryset.iterator(chunk_size=...), ...) stands in for
+# chunkator_page(queryset, ...), which the examples use, so the tests don't depend on django-chunkator.
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    # itertools.batched is only available from python 3.12, and process_chunk wants lists anyway
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def create_books_and_reviews(count: int) -> None:
+    # same data as BookFactory.create_batch(count) and ReviewFactory.create_batch(count),
+    # but inserted with a bulk_create per table rather than a few queries per object
+    books = BookFactory.build_batch(count)
+    reviews = ReviewFactory.build_batch(count)
+    all_books = books + [review.book for review in reviews]
+
+    Author.objects.bulk_create([author for book in all_books for author in (book.author, book.translator)])
+    Publisher.objects.bulk_create([book.publisher for book in all_books])
+    Book.objects.bulk_create(all_books)
+
+    categories_per_book = [CategoryFactory.build_batch(random.randint(1, 3)) for _ in all_books]
+    Category.objects.bulk_create(list(itertools.chain.from_iterable(categories_per_book)))
+    Book.categories.through.objects.bulk_create(
+        [
+            Book.categories.through(book_id=book.id, category_id=category.id)
+            for book, categories in zip(all_books, categories_per_book, strict=True)
+            for category in categories
+        ]
+    )
+
+    Review.objects.bulk_create(reviews)
+
+
+@pytest.fixture(scope="class")
+def books_and_reviews(django_db_setup, django_db_blocker) -> Iterator[None]:
+    # the tests only read the data, so it's created once for the whole class, and rolled back afterwards.
+    # Each test still runs in its own transaction, nested inside this one
+    with django_db_blocker.unblock(), transaction.atomic():
+        create_books_and_reviews(100)
+        yield
+        transaction.set_rollback(True)
 
+
+@pytest.mark.usefixtures("books_and_reviews")
+class TestReadmeExamples:
     def test_basic_naive(self):
-        for chunk in chunkator_page(Book.objects.all().prefetch_related("author", "translator", "publisher"), 10_000):
+        for chunk in batched(
+            Book.objects.all().prefetch_related("author", "translator", "publisher").iterator(chunk_size=10_000), 10_000
+        ):
             for book in chunk:
                 print(book.author.name, book.translator.name if book.translator is not None else None)
                 print(book.publisher.name)
 
     def test_basic(self):
         memoized_prefetch = MemoizedPrefetch(
-            MemoizedPrefetchConfig(Author, ["author", "translator"]),
-            MemoizedPrefetchConfig(Publisher, ["publisher"], prefetch_all=True),
+            MemoizedPrefetchConfig(Author, ["author", "translator"], queryset=Author.objects.only("id", "name")),
+            MemoizedPrefetchConfig(
+                Publisher, ["publisher"], queryset=Publisher.objects.only("id", "name"), prefetch_all=True
+            ),
         )
 
-        for chunk in chunkator_page(Book.objects.all(), 10_000):
+        for chunk in batched(Book.objects.all().iterator(chunk_size=10_000), 10_000):
             memoized_prefetch.process_chunk(chunk)
 
             for book in chunk:
                 print(book.author.name, book.translator.name if book.translator is not None else None)
                 print(book.publisher.name)
 
-    def test_nested(self):
+    def test_nested(self, django_assert_num_queries: DjangoAssertNumQueries):
         memoized_prefetch = MemoizedPrefetch(
-            MemoizedPrefetchConfig(Publisher, ["book.publisher"]),
-            MemoizedPrefetchConfig(Author, ["book__author"]),
+            # the nested attributes below go through `book`, so the books are fetched once for all of them
+            MemoizedPrefetchConfig(Book, ["book"]),
+            MemoizedPrefetchConfig(Publisher, ["book.publisher"], queryset=Publisher.objects.only("id", "name")),
+            MemoizedPrefetchConfig(Author, ["book__author"], queryset=Author.objects.only("id", "name")),
         )
 
-        for chunk in chunkator_page(Review.objects.all(), 10000):
-            memoized_prefetch.process_chunk(chunk)
+        for chunk in batched(Review.objects.all().iterator(chunk_size=10_000), 10_000):
+            # books, publishers and authors
+            with django_assert_num_queries(3):
+                memoized_prefetch.process_chunk(chunk)
 
-    def test_m2m(self):
+            for review in chunk:
+                print(review.book.title, review.book.publisher.name, review.book.author.name)
+
+    def test_m2m(self, django_assert_num_queries: DjangoAssertNumQueries):
         # Configure for many-to-many relationships
         memoized_prefetch = MemoizedPrefetch(
             MemoizedPrefetchConfig(
                 model=Category,
                 attributes=["categories"],
+                queryset=Category.objects.only("id", "name"),
                 is_many_to_many=True,
                 through_model=Book.categories.through,
                 source_field="book_id",
@@ -56,10 +112,17 @@ class TestReadmeExamples:
         )
 
         # Process books with their categories
-        for chunk in chunkator_page(Book.objects.all(), 10000):
-            memoized_prefetch.process_chunk(chunk)
+        for chunk in batched(Book.objects.all().iterator(chunk_size=10_000), 10_000):
+            # the through model rows, and the categories which are not memoized yet
+            with django_assert_num_queries(2):
+                memoized_prefetch.process_chunk(chunk)
 
-            for book in chunk:
-                # Categories are prefetched and available
-                category_names = [cat.name for cat in book.categories.all()]
-                print(f"Book: {book.title}, Categories: {', '.join(category_names)}")
+            with django_assert_num_queries(0):
+                for book in chunk:
+                    # Categories are prefetched and available
+                    category_names = [cat.name for cat in book.categories.all()]
+                    print(f"Book: {book.title}, Categories: {', '.join(category_names)}")
+
+            # both the through model rows and the categories are memoized now
+            with django_assert_num_queries(0):
+                memoized_prefetch.process_chunk(chunk)
@@ -0,0 +1,44 @@
+import gc
+
+import pytest
+
+from django_memoized_prefetch._weak_lru import WeakValueLRU
+from tests.test_project.test_app.models import SomeParentModel
+
+
+class TestWeakValueLRU:
+    def test_weak_value_lru(self):
+        cache = WeakValueLRU(2)
+        a, b, c = SomeParentModel(id=1), SomeParentModel(id=2), SomeParentModel(id=3)
+
+        cache[1] = a
+        cache.update({2: b})
+
+        assert 1 in cache
+        assert cache[1] is a
+        assert cache.get(2) is b
+        assert len(cache) == 2
+        assert cache.get_size() == 2
+
+        cache[3] = c  # evicts the least recently used
+
+        assert 1 not in cache
+        assert sorted(cache) == [2, 3]
+        assert sorted(obj.id for obj in cache.values()) == [2, 3]
+
+        cache.set_size(1)
+
+        assert cache.get_size() == 1
+        assert len(cache) == 1
+
+    def test_garbage_collected(self):
+        cache = WeakValueLRU(10)
+        cache[1] = SomeParentModel(id=1)
+        gc.collect()
+
+        assert 1 not in cache
+        assert cache.get(1, "default") == "default"
+        assert len(cache) == 0
+
+        with pytest.raises(KeyError):
+            cache[1]